@@ -74,7 +74,7 @@ install_packages() {
         logrotate > /dev/null
     
     # Install Python packages
-    pip3 install requests > /dev/null
+    pip3 install pyroute2 python-iptables > /dev/null
     
     log "Tüm paketler başarıyla kuruldu"
 }
@@ -6,40 +6,100 @@ Supports instant VPN switching with policy-based routing
 
 import os
 import sys
+import atexit
 import time
-import json
 import subprocess
 import threading
 import logging
+import logging.handlers
+import queue
+import heapq
 import random
-from datetime import datetime, timedelta
+import statistics
+import select
+import socket
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed, wait
 from pathlib import Path
-import requests
 import signal
+import errno
+import pwd
+import iptc
+from pyroute2 import IPRoute
+from pyroute2.netlink.rtnl import RTMGRP_LINK, RTMGRP_IPV4_IFADDR
+from pyroute2.netlink.exceptions import NetlinkError
+
+VPNConfig = namedtuple('VPNConfig', 'country file name')
+
+VPN_ROUTING_MARK = 100
+VPN_PRIMARY_TABLE = 100  # 'vpn_primary' in /etc/iproute2/rt_tables
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+def _icmp_checksum(data):
+    """RFC 1071 internet checksum"""
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
 
 class VPNRotationManager:
     def __init__(self, config_dir="/etc/openvpn"):
         # Logging setup FIRST
+        # Workers only enqueue records, file/stdout writes happen on the listener thread
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        output_handlers = [
+            logging.FileHandler('/var/log/vpn_rotation.log'),
+            logging.StreamHandler(sys.stdout)
+        ]
+        for handler in output_handlers:
+            handler.setFormatter(formatter)
+        
+        log_queue = queue.Queue(-1)
+        self._log_listener = logging.handlers.QueueListener(log_queue, *output_handlers)
+        self._log_listener.start()
+        atexit.register(self._stop_log_listener)  # Flush on every exit path, not only stop()
         logging.basicConfig(
             level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler('/var/log/vpn_rotation.log'),
-                logging.StreamHandler(sys.stdout)
-            ]
+            format='%(message)s',  # Full format is applied by the output handlers
+            handlers=[logging.handlers.QueueHandler(log_queue)]
         )
         self.logger = logging.getLogger(__name__)
         
         # Now initialize other attributes
         self.config_dir = Path(config_dir)
         self.vpn_configs = self._load_vpn_configs()
-        self.blacklisted_vpns = {}  # VPN -> timestamp when blacklisted
+        self.blacklisted_vpns = {}  # VPN -> monotonic timestamp when blacklisted
+        self._blacklist_heap = []  # (expiry timestamp, VPN) min-heap
+        self._available_cache = None  # Non-blacklisted VPNs, rebuilt on blacklist change
+        self._blacklist_lock = threading.Lock()  # Held only while mutating blacklist state
+        self._rtt = {}  # VPN -> EWMA of ping RTT in seconds, biases VPN selection
         self.current_primary = None
         self.current_secondary = None
+        self.primary_interface = "tun0"
+        self.secondary_interface = "tun1"
+        self._spare = None  # Pre-connected VPN that the next rotation switches to
+        self._spare_interface = "tun2"
+        self._spare_thread = None
+        self._roles_lock = threading.RLock()  # Guards role/interface swaps and their teardown
+        self._reserved_vpns = set()  # VPNs being connected, not yet in a role
+        self._health_event = threading.Event()  # Set to request an immediate health check
+        self._stop_event = threading.Event()  # Set by stop() to wake sleeping workers
+        self._health_thread = None
+        self._rotation_thread = None
         self.rotation_interval = 30 * 60  # 30 minutes
         self.health_check_interval = 5 * 60  # 5 minutes
+        self.min_health_check_interval = 10  # Floor while VPNs are failing
         self.blacklist_duration = 24 * 60 * 60  # 24 hours
         self.running = False
+        self._botuser_uid = pwd.getpwnam('botuser').pw_uid  # Resolved once, not per switch
+        self._probe_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="vpn-probe")
+        self._ipr = IPRoute()  # Netlink socket for rule/route changes
         
         # Signal handlers for graceful shutdown
         signal.signal(signal.SIGTERM, self._signal_handler)
@@ -54,22 +114,22 @@ class VPNRotationManager:
     def _load_vpn_configs(self):
         """Load all VPN configuration files"""
         configs = []
-        for conf_file in self.config_dir.glob("mullvad_*_all.conf"):
-            country_code = conf_file.stem.split('_')[1]
-            configs.append({
-                'country': country_code,
-                'file': conf_file,
-                'name': f"mullvad_{country_code}"
-            })
+        with os.scandir(self.config_dir) as entries:
+            for entry in entries:
+                file_name = entry.name
+                if file_name.startswith('mullvad_') and file_name.endswith('_all.conf'):
+                    country_code = file_name[len('mullvad_'):-len('_all.conf')]
+                    configs.append(VPNConfig(country_code, entry.path, f"mullvad_{country_code}"))
         self.logger.info(f"Loaded {len(configs)} VPN configurations")
-        return configs
+        return tuple(configs)
     
-    def _run_command(self, command, timeout=30):
-        """Execute shell command with timeout"""
+    def _run_command(self, argv, timeout=30):
+        """Execute command (argv list, no shell) with timeout"""
+        command = ' '.join(argv)
         try:
             result = subprocess.run(
-                command, 
-                shell=True, 
+                argv, 
+                shell=False, 
                 capture_output=True, 
                 text=True, 
                 timeout=timeout
@@ -84,284 +144,552 @@ class VPNRotationManager:
     
     def _get_available_vpns(self):
         """Get VPNs that are not blacklisted"""
-        current_time = time.time()
-        available_vpns = []
-        
-        for vpn in self.vpn_configs:
-            vpn_name = vpn['name']
-            if vpn_name in self.blacklisted_vpns:
-                if current_time - self.blacklisted_vpns[vpn_name] < self.blacklist_duration:
-                    continue  # Still blacklisted
-                else:
-                    # Remove from blacklist
-                    del self.blacklisted_vpns[vpn_name]
-                    self.logger.info(f"Removed {vpn_name} from blacklist")
+        current_time = time.monotonic()
+        
+        # Fast path without the lock: nothing has expired and the cache is valid.
+        # Index instead of a truthiness check, another thread may pop the last entry
+        available_vpns = self._available_cache
+        try:
+            next_expiry = self._blacklist_heap[0][0]
+        except IndexError:
+            next_expiry = float('inf')
+        if available_vpns is not None and next_expiry > current_time:
+            return available_vpns
+        
+        expired = []
+        with self._blacklist_lock:
+            # Pop expired blacklist entries in expiry order
+            while self._blacklist_heap and self._blacklist_heap[0][0] <= current_time:
+                _, vpn_name = heapq.heappop(self._blacklist_heap)
+                
+                # Re-blacklisting leaves a stale heap entry behind, skip it
+                blacklisted_at = self.blacklisted_vpns.get(vpn_name)
+                if blacklisted_at is None or current_time - blacklisted_at < self.blacklist_duration:
+                    continue
+                
+                del self.blacklisted_vpns[vpn_name]
+                self._available_cache = None
+                expired.append(vpn_name)
             
-            available_vpns.append(vpn)
+            if self._available_cache is None:
+                self._available_cache = [vpn for vpn in self.vpn_configs
+                                         if vpn.name not in self.blacklisted_vpns]
+            available_vpns = self._available_cache
+        
+        for vpn_name in expired:
+            self.logger.info(f"Removed {vpn_name} from blacklist")
         
         return available_vpns
     
     def _setup_routing_tables(self):
         """Setup custom routing tables for VPN traffic"""
-        # Add custom routing tables
-        commands = [
-            "echo '100 vpn_primary' >> /etc/iproute2/rt_tables",
-            "echo '101 vpn_secondary' >> /etc/iproute2/rt_tables",
+        # Add custom routing tables, only the entries that are missing
+        rt_tables = Path('/etc/iproute2/rt_tables')
+        try:
+            existing = rt_tables.read_text()
+            existing_lines = {line.strip() for line in existing.splitlines()}
+            to_add = [line for line in ('100 vpn_primary', '101 vpn_secondary')
+                      if line not in existing_lines]
+            if to_add:
+                rt_tables.write_text(existing.rstrip('\n') + '\n' + '\n'.join(to_add) + '\n')
+        except OSError as e:
+            self.logger.warning(f"Routing setup warning: rt_tables - {str(e)}")
+        
+        # Create routing rules for bot processes
+        # You'll need to identify your bot processes and route them through VPN
+        mangle = iptc.Table(iptc.Table.MANGLE)
+        mangle.refresh()
+        try:
+            if not mangle.is_chain("VPN_ROUTING"):
+                mangle.create_chain("VPN_ROUTING")
             
-            # Create routing rules for bot processes
-            # You'll need to identify your bot processes and route them through VPN
-            "iptables -t mangle -N VPN_ROUTING",
-            "iptables -t mangle -A OUTPUT -j VPN_ROUTING",
-        ]
-        
-        for cmd in commands:
-            success, stdout, stderr = self._run_command(cmd)
-            if not success and "File exists" not in stderr:
-                self.logger.warning(f"Routing setup warning: {cmd} - {stderr}")
+            output = iptc.Chain(mangle, "OUTPUT")
+            if not any(rule.target.name == "VPN_ROUTING" for rule in output.rules):
+                jump = iptc.Rule()
+                jump.create_target("VPN_ROUTING")
+                output.append_rule(jump)
+        except iptc.IPTCError as e:
+            self.logger.warning(f"Routing setup warning: VPN_ROUTING chain - {str(e)}")
+        
+        # Mark bot traffic and point marked packets at vpn_primary once,
+        # switching then only has to replace the default route in that table
+        try:
+            chain = iptc.Chain(mangle, "VPN_ROUTING")
+            chain.flush()
+            
+            rule = iptc.Rule()
+            owner = rule.create_match("owner")
+            owner.uid_owner = str(self._botuser_uid)
+            mark = rule.create_target("MARK")
+            mark.set_mark = str(VPN_ROUTING_MARK)
+            chain.append_rule(rule)
+            
+            try:
+                self._ipr.rule('add', fwmark=VPN_ROUTING_MARK, table=VPN_PRIMARY_TABLE)
+            except NetlinkError as e:
+                if e.code != errno.EEXIST:
+                    raise
+        except (iptc.IPTCError, NetlinkError) as e:
+            self.logger.warning(f"Routing setup warning: bot traffic mark - {str(e)}")
     
     def _connect_vpn(self, vpn_config, interface_name):
         """Connect to a specific VPN"""
-        self.logger.info(f"Connecting to {vpn_config['name']} on {interface_name}")
+        self.logger.info(f"Connecting to {vpn_config.name} on {interface_name}")
         
         # Stop any existing connection on this interface
         self._disconnect_vpn(interface_name)
         
         # Start OpenVPN connection
-        cmd = f"""
-        openvpn --config {vpn_config['file']} \
-                --dev {interface_name} \
-                --daemon \
-                --writepid /var/run/openvpn_{interface_name}.pid \
-                --log-append /var/log/openvpn_{interface_name}.log \
-                --cd {self.config_dir}
-        """
-        
-        success, stdout, stderr = self._run_command(cmd)
-        if not success:
-            self.logger.error(f"Failed to connect VPN: {stderr}")
-            return False
+        cmd = [
+            "openvpn",
+            "--config", vpn_config.file,
+            "--dev", interface_name,
+            "--daemon",
+            "--writepid", f"/var/run/openvpn_{interface_name}.pid",
+            "--log-append", f"/var/log/openvpn_{interface_name}.log",
+            "--cd", str(self.config_dir),
+            # Options after --config override the file
+            "--fast-io",
+            "--mlock",
+            "--auth-nocache",  # Credentials are re-read from the auth file when needed
+            "--server-poll-timeout", "10",  # Move on from a dead remote within our 30s budget
+        ]
         
-        # Wait for connection to establish
-        for _ in range(30):  # Wait up to 30 seconds
-            if self._check_vpn_interface(interface_name):
-                self.logger.info(f"VPN {vpn_config['name']} connected successfully on {interface_name}")
+        # Subscribe to link/address events before launching so none are missed
+        with IPRoute() as monitor:
+            monitor.bind(groups=RTMGRP_LINK | RTMGRP_IPV4_IFADDR)
+            
+            success, stdout, stderr = self._run_command(cmd)
+            if not success:
+                self.logger.error(f"Failed to connect VPN: {stderr}")
+                return False
+            
+            # Wait for connection to establish
+            if self._wait_for_vpn_interface(monitor, interface_name, timeout=30):
+                self.logger.info(f"VPN {vpn_config.name} connected successfully on {interface_name}")
                 return True
-            time.sleep(1)
         
-        self.logger.error(f"VPN {vpn_config['name']} failed to establish connection")
+        self.logger.error(f"VPN {vpn_config.name} failed to establish connection")
         return False
     
+    def _wait_for_vpn_interface(self, monitor, interface_name, timeout):
+        """Block until the interface gets an IPv4 address or timeout expires"""
+        deadline = time.monotonic() + timeout
+        
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            
+            # Wake up as soon as the kernel reports a change
+            ready, _, _ = select.select([monitor.fileno()], [], [], remaining)
+            if not ready:
+                return False
+            
+            for msg in monitor.get():
+                if (msg['event'] == 'RTM_NEWADDR'
+                        and msg.get_attr('IFA_LABEL') == interface_name
+                        and msg.get_attr('IFA_ADDRESS')):
+                    return True
+    
     def _disconnect_vpn(self, interface_name):
         """Disconnect VPN on specific interface"""
         pid_file = f"/var/run/openvpn_{interface_name}.pid"
         if os.path.exists(pid_file):
-            with open(pid_file, 'r') as f:
-                pid = f.read().strip()
-            
-            success, _, _ = self._run_command(f"kill {pid}")
-            if success:
+            try:
+                with open(pid_file, 'r') as f:
+                    pid = int(f.read().strip())
+                
+                os.kill(pid, signal.SIGTERM)
                 self.logger.info(f"Disconnected VPN on {interface_name}")
+            except (ValueError, ProcessLookupError) as e:
+                self.logger.warning(f"Stale pid file for {interface_name}: {str(e)}")
             
             os.remove(pid_file)
     
     def _check_vpn_interface(self, interface_name):
         """Check if VPN interface is up and has IP"""
-        success, stdout, _ = self._run_command(f"ip addr show {interface_name}")
-        return success and "inet " in stdout
+        return bool(self._ipr.get_addr(label=interface_name, family=socket.AF_INET))
     
-    def _test_vpn_connectivity(self, interface_name):
-        """Test if VPN is working by checking external IP"""
-        test_urls = [
-            "https://httpbin.org/ip",
-            "https://api.ipify.org?format=json",
-            "https://ipecho.net/plain"
-        ]
+    def _ping(self, interface_name, address, count=5, interval=0.4, timeout=1.0):
+        """Send ICMP echoes out of a specific interface, return list of RTTs"""
+        rtts = []
+        ident = (os.getpid() ^ threading.get_ident()) & 0xFFFF
+        
+        with socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP) as sock:
+            # Force packets out of the VPN interface regardless of routing tables
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface_name.encode())
+            
+            for seq in range(count):
+                header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+                payload = struct.pack('!d', time.time())
+                checksum = _icmp_checksum(header + payload)
+                packet = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+                
+                sent_at = time.monotonic()
+                sock.sendto(packet, (address, 0))
+                
+                # Wait for the matching echo reply
+                while True:
+                    remaining = timeout - (time.monotonic() - sent_at)
+                    if remaining <= 0:
+                        break
+                    ready, _, _ = select.select([sock], [], [], remaining)
+                    if not ready:
+                        break
+                    data, _ = sock.recvfrom(1024)
+                    ip_header_len = (data[0] & 0x0F) * 4
+                    reply_type, _, _, reply_id, reply_seq = struct.unpack(
+                        '!BBHHH', data[ip_header_len:ip_header_len + 8])
+                    if reply_type == ICMP_ECHO_REPLY and reply_id == ident and reply_seq == seq:
+                        rtts.append(time.monotonic() - sent_at)
+                        break
+                
+                # Spread echoes over a small window instead of a one-shot burst
+                if seq < count - 1:
+                    delay = interval - (time.monotonic() - sent_at)
+                    if delay > 0:
+                        time.sleep(delay)
         
-        for url in test_urls:
-            try:
-                # Route this specific request through the VPN interface
-                cmd = f"curl -s --interface {interface_name} --max-time 10 {url}"
-                success, stdout, stderr = self._run_command(cmd)
+        return rtts
+    
+    def _test_vpn_connectivity(self, interface_name, vpn_name=None):
+        """Test if VPN is working by pinging anycast resolvers through it"""
+        ping_targets = ["1.1.1.1", "9.9.9.9"]
+        count = 5
+        
+        # A tunnel without an address can't pass, skip the ping window
+        if not self._check_vpn_interface(interface_name):
+            self.logger.error(f"VPN {interface_name} has no IPv4 address")
+            return False
+        
+        # Ping all targets at once and accept the first one that answers
+        executor = ThreadPoolExecutor(max_workers=len(ping_targets))
+        try:
+            futures = [executor.submit(self._ping, interface_name, address, count)
+                       for address in ping_targets]
+            
+            for future in as_completed(futures, timeout=count * 2):
+                try:
+                    rtts = future.result()
+                except Exception as e:
+                    self.logger.warning(f"Connectivity test failed for {interface_name}: {str(e)}")
+                    continue
                 
-                if success and stdout.strip():
+                # Require at least 2/3 of the echoes to come back
+                if len(rtts) * 3 >= count * 2:
+                    if vpn_name:
+                        self._record_rtt(vpn_name, statistics.fmean(rtts))
                     self.logger.info(f"VPN {interface_name} connectivity test passed")
                     return True
-                    
-            except Exception as e:
-                self.logger.warning(f"Connectivity test failed for {interface_name}: {str(e)}")
-                continue
+        except FutureTimeoutError:
+            self.logger.warning(f"Connectivity test timed out for {interface_name}")
+        finally:
+            # Don't wait for slower targets once the outcome is known
+            executor.shutdown(wait=False, cancel_futures=True)
         
         self.logger.error(f"VPN {interface_name} connectivity test failed")
         return False
     
+    def _record_rtt(self, vpn_name, sample):
+        """Fold a ping RTT sample into the VPN's moving average"""
+        previous = self._rtt.get(vpn_name)
+        self._rtt[vpn_name] = sample if previous is None else 0.8 * previous + 0.2 * sample
+    
+    def _choose_vpn(self, candidates):
+        """Pick a VPN at random, weighted towards low observed RTT"""
+        weights = [1.0 / max(self._rtt[vpn.name], 0.005) if vpn.name in self._rtt else None
+                   for vpn in candidates]
+        
+        # VPNs without measurements get the median weight so they still get tried
+        known = [weight for weight in weights if weight is not None]
+        default_weight = statistics.median(known) if known else 1.0
+        weights = [default_weight if weight is None else weight for weight in weights]
+        
+        return random.choices(candidates, weights=weights, k=1)[0]
+    
     def _switch_primary_routing(self, new_interface):
         """Switch primary routing to new VPN interface - INSTANT SWITCH"""
         self.logger.info(f"Switching primary routing to {new_interface}")
         
-        commands = [
-            # Clear old routing rules for bot traffic
-            "iptables -t mangle -F VPN_ROUTING",
-            
-            # Route bot traffic through new primary VPN
-            f"iptables -t mangle -A VPN_ROUTING -m owner --uid-owner $(id -u botuser) -j MARK --set-mark 100",
-            f"ip rule add fwmark 100 table vpn_primary",
-            f"ip route add default dev {new_interface} table vpn_primary",
-            
-            # Flush route cache for immediate effect
-            "ip route flush cache"
-        ]
-        
-        for cmd in commands:
-            success, stdout, stderr = self._run_command(cmd)
-            if not success:
-                self.logger.error(f"Routing switch failed: {cmd} - {stderr}")
-                return False
+        try:
+            # Kernel swaps the route atomically, marked traffic is never unrouted
+            ifindex = self._ipr.link_lookup(ifname=new_interface)[0]
+            self._ipr.route('replace', dst='default', oif=ifindex, table=VPN_PRIMARY_TABLE)
+        except Exception as e:
+            self.logger.error(f"Routing switch failed: {new_interface} - {str(e)}")
+            return False
         
         self.logger.info(f"Primary routing switched to {new_interface} successfully")
         return True
     
     def _blacklist_vpn(self, vpn_name):
         """Add VPN to blacklist"""
-        self.blacklisted_vpns[vpn_name] = time.time()
+        blacklisted_at = time.monotonic()
+        with self._blacklist_lock:
+            self.blacklisted_vpns[vpn_name] = blacklisted_at
+            heapq.heappush(self._blacklist_heap, (blacklisted_at + self.blacklist_duration, vpn_name))
+            self._available_cache = None
         self.logger.warning(f"Blacklisted VPN: {vpn_name} for 24 hours")
     
     def _health_check_worker(self):
         """Background worker for health checks"""
+        current_interval = self.health_check_interval
+        consecutive_successes = 0
+        
         while self.running:
             try:
-                # Check primary VPN
-                if self.current_primary and not self._test_vpn_connectivity("tun0"):
-                    self.logger.error("Primary VPN failed health check")
-                    self._blacklist_vpn(self.current_primary['name'])
-                    self._emergency_switch()
+                # Retry a spare that failed to provision, else rotation skips a whole interval
+                if not self._spare:
+                    self._provision_spare_async()
                 
-                # Check secondary VPN 
-                if self.current_secondary and not self._test_vpn_connectivity("tun1"):
-                    self.logger.error("Secondary VPN failed health check")
-                    self._blacklist_vpn(self.current_secondary['name'])
-                    self._prepare_new_secondary()
+                # Snapshot roles so each probe targets the interface its VPN is on
+                with self._roles_lock:
+                    roles = [
+                        ("primary", self.current_primary, self.primary_interface),
+                        ("secondary", self.current_secondary, self.secondary_interface),
+                        ("spare", self._spare, self._spare_interface),
+                    ]
                 
-                time.sleep(self.health_check_interval)
+                # Probe all tunnels concurrently - they are independent
+                probes = {}
+                for role, vpn, interface in roles:
+                    if vpn:
+                        future = self._probe_pool.submit(self._test_vpn_connectivity,
+                                                      interface, vpn.name)
+                        probes[future] = (role, vpn)
+                
+                # Collect every result before acting, recovery can outlast the probe deadline
+                done, not_done = wait(probes, timeout=15)
+                all_passed = not not_done
+                for future in not_done:
+                    role, vpn = probes[future]
+                    self.logger.warning(f"{role.capitalize()} VPN health check timed out: {vpn.name}")
+                
+                # Primary first, so a failover happens before secondary/spare handling
+                for future, (role, vpn) in probes.items():
+                    if future not in done or future.result():
+                        continue
+                    
+                    all_passed = False
+                    if role == "primary":
+                        # Skipped if a rotation already retired this primary
+                        with self._roles_lock:
+                            failed = self.current_primary is vpn
+                            if failed:
+                                self.logger.error("Primary VPN failed health check")
+                                self._blacklist_vpn(vpn.name)
+                        if failed:
+                            self._emergency_switch(vpn)
+                    elif role == "secondary":
+                        # Skipped if an emergency switch already promoted this secondary
+                        with self._roles_lock:
+                            failed = self.current_secondary is vpn
+                            if failed:
+                                self.logger.error("Secondary VPN failed health check")
+                                self._blacklist_vpn(vpn.name)
+                        if failed:
+                            self._prepare_new_secondary()
+                    else:
+                        # Skipped if a rotation already promoted this spare
+                        with self._roles_lock:
+                            failed = self._spare is vpn
+                            if failed:
+                                self.logger.error("Spare VPN failed health check")
+                                self._blacklist_vpn(vpn.name)
+                                self._spare = None
+                                self._disconnect_vpn(self._spare_interface)
+                        if failed:
+                            self._provision_spare_async()
                 
             except Exception as e:
                 self.logger.error(f"Health check worker error: {str(e)}")
-                time.sleep(60)  # Wait before retrying
+                all_passed = False
+            
+            # Check more often while VPNs flap, back off again once stable
+            if all_passed:
+                consecutive_successes += 1
+                if consecutive_successes >= 3:
+                    current_interval = min(self.health_check_interval, current_interval * 2)
+                    consecutive_successes = 0
+            else:
+                consecutive_successes = 0
+                current_interval = max(self.min_health_check_interval, current_interval // 2)
+            
+            # Sleep until the next check or until a switch requests one early
+            self._health_event.wait(current_interval)
+            self._health_event.clear()
+            if self._stop_event.is_set():
+                return
     
-    def _emergency_switch(self):
+    def _emergency_switch(self, failed_vpn):
         """Emergency switch to secondary VPN"""
-        if not self.current_secondary:
-            self.logger.critical("No secondary VPN available for emergency switch!")
-            return False
-        
-        self.logger.warning("Performing emergency switch to secondary VPN")
-        
-        # Instant switch to secondary
-        success = self._switch_primary_routing("tun1")
-        if success:
-            # Promote secondary to primary
-            old_primary = self.current_primary
+        with self._roles_lock:
+            # A rotation may have retired the failed primary in the meantime
+            if self.current_primary is not failed_vpn:
+                return False
+            
+            if not self.current_secondary:
+                self.logger.critical("No secondary VPN available for emergency switch!")
+                return False
+            
+            self.logger.warning("Performing emergency switch to secondary VPN")
+            
+            # Instant switch to secondary
+            if not self._switch_primary_routing(self.secondary_interface):
+                return False
+            
+            # Promote secondary to primary, failed interface hosts the next secondary
+            failed_interface = self.primary_interface
             self.current_primary = self.current_secondary
+            self.primary_interface = self.secondary_interface
             self.current_secondary = None
+            self.secondary_interface = failed_interface
             
             # Disconnect failed VPN
-            self._disconnect_vpn("tun0")
-            
-            # Prepare new secondary
-            self._prepare_new_secondary()
-            
-            return True
+            self._disconnect_vpn(failed_interface)
         
-        return False
+        # Prepare new secondary
+        self._prepare_new_secondary()
+        
+        self._health_event.set()
+        return True
     
     def _prepare_new_secondary(self):
         """Prepare a new secondary VPN connection"""
+        new_secondary = self._reserve_vpn()
+        if not new_secondary:
+            self.logger.error("No available VPNs for secondary connection")
+            return False
+        
+        try:
+            # Connect to secondary interface
+            interface = self.secondary_interface
+            if self._connect_vpn(new_secondary, interface):
+                if self._test_vpn_connectivity(interface, new_secondary.name):
+                    with self._roles_lock:
+                        self.current_secondary = new_secondary
+                    self.logger.info(f"New secondary VPN ready: {new_secondary.name}")
+                    return True
+                else:
+                    self._blacklist_vpn(new_secondary.name)
+                    self._disconnect_vpn(interface)
+        finally:
+            self._release_vpn(new_secondary)
+        
+        return False
+    
+    def _active_vpn_names(self):
+        """Names of VPNs connected as primary, secondary or spare, or being connected"""
+        active = {vpn.name for vpn in (self.current_primary, self.current_secondary, self._spare)
+                  if vpn}
+        return active | self._reserved_vpns
+    
+    def _reserve_vpn(self):
+        """Pick an unused VPN and reserve it so a concurrent connect can't pick it too"""
         available_vpns = self._get_available_vpns()
         
-        # Filter out current primary
-        if self.current_primary:
+        with self._roles_lock:
+            # Filter out VPNs already in use
+            excluded_names = self._active_vpn_names()
             available_vpns = [vpn for vpn in available_vpns 
-                            if vpn['name'] != self.current_primary['name']]
-        
-        if not available_vpns:
-            self.logger.error("No available VPNs for secondary connection")
+                              if vpn.name not in excluded_names]
+            if not available_vpns:
+                return None
+            
+            # Favour low-latency exits
+            vpn = self._choose_vpn(available_vpns)
+            self._reserved_vpns.add(vpn.name)
+            return vpn
+    
+    def _release_vpn(self, vpn):
+        """Drop a reservation once the VPN holds a role or was given up"""
+        with self._roles_lock:
+            self._reserved_vpns.discard(vpn.name)
+    
+    def _prepare_spare(self):
+        """Connect and verify the warm spare VPN used by the next rotation"""
+        new_spare = self._reserve_vpn()
+        if not new_spare:
+            self.logger.warning("No available VPNs for spare connection")
             return False
         
-        # Select random VPN for secondary
-        new_secondary = random.choice(available_vpns)
-        
-        # Connect to secondary interface
-        if self._connect_vpn(new_secondary, "tun1"):
-            if self._test_vpn_connectivity("tun1"):
-                self.current_secondary = new_secondary
-                self.logger.info(f"New secondary VPN ready: {new_secondary['name']}")
-                return True
-            else:
-                self._blacklist_vpn(new_secondary['name'])
-                self._disconnect_vpn("tun1")
+        try:
+            interface = self._spare_interface
+            if self._connect_vpn(new_spare, interface):
+                if self._test_vpn_connectivity(interface, new_spare.name):
+                    with self._roles_lock:
+                        self._spare = new_spare
+                    self.logger.info(f"New spare VPN ready: {new_spare.name} on {interface}")
+                    return True
+                else:
+                    self._blacklist_vpn(new_spare.name)
+                    self._disconnect_vpn(interface)
+        finally:
+            self._release_vpn(new_spare)
         
         return False
     
+    def _provision_spare_async(self):
+        """Connect a new spare in the background unless one is already in progress"""
+        if self._spare_thread and self._spare_thread.is_alive():
+            return
+        
+        self._spare_thread = threading.Thread(target=self._prepare_spare, daemon=True)
+        self._spare_thread.start()
+    
     def _rotation_worker(self):
         """Background worker for VPN rotation"""
         while self.running:
             try:
                 # Wait for rotation interval
-                time.sleep(self.rotation_interval)
-                
-                if not self.running:
+                if self._stop_event.wait(self.rotation_interval):
                     break
                 
                 self.logger.info("Starting VPN rotation")
                 
-                # Prepare new VPN for rotation
-                available_vpns = self._get_available_vpns()
+                if not self._spare:
+                    # Connect one now rather than postponing rotation a full interval
+                    self.logger.warning("No spare VPN ready for rotation, provisioning one now")
+                    self._provision_spare_async()
+                    self._spare_thread.join(timeout=60)
+                    if not self._spare:
+                        self.logger.warning("No spare VPN available, skipping this rotation")
+                        continue
                 
-                # Filter out current VPNs
-                excluded_names = []
-                if self.current_primary:
-                    excluded_names.append(self.current_primary['name'])
-                if self.current_secondary:
-                    excluded_names.append(self.current_secondary['name'])
-                
-                available_vpns = [vpn for vpn in available_vpns 
-                                if vpn['name'] not in excluded_names]
-                
-                if not available_vpns:
-                    self.logger.warning("No available VPNs for rotation")
-                    continue
-                
-                # Select new VPN
-                new_vpn = random.choice(available_vpns)
+                with self._roles_lock:
+                    new_vpn = self._spare
+                    new_interface = self._spare_interface
+                    
+                    # Spare may have failed a health check since the check above
+                    if not new_vpn:
+                        self.logger.warning("Spare VPN dropped before rotation, skipping")
+                        continue
+                    
+                    # INSTANT SWITCH: spare is already connected and health-checked
+                    switched = self._switch_primary_routing(new_interface)
+                    if switched:
+                        old_primary = self.current_primary
+                        old_interface = self.primary_interface
+                        
+                        # Spare becomes primary, old primary interface hosts the next spare
+                        self.current_primary = new_vpn
+                        self.primary_interface = new_interface
+                        self._spare = None
+                        self._spare_interface = old_interface
+                        
+                        self._disconnect_vpn(old_interface)
                 
-                # Connect new VPN on tun2 (temporary)
-                if self._connect_vpn(new_vpn, "tun2"):
-                    if self._test_vpn_connectivity("tun2"):
-                        # INSTANT SWITCH: Change routing to tun2
-                        if self._switch_primary_routing("tun2"):
-                            # Cleanup old primary
-                            if self.current_primary:
-                                self._disconnect_vpn("tun0")
-                            
-                            # Promote tun2 to tun0 and secondary to primary position
-                            # This is a bit complex but ensures we always have backup
-                            self._disconnect_vpn("tun2")
-                            if self._connect_vpn(new_vpn, "tun0"):
-                                self._switch_primary_routing("tun0")
-                                
-                                old_primary = self.current_primary
-                                self.current_primary = new_vpn
-                                
-                                self.logger.info(f"VPN rotation completed: {old_primary['name'] if old_primary else 'None'} -> {new_vpn['name']}")
-                            
-                        else:
-                            self._disconnect_vpn("tun2")
-                    else:
-                        self._blacklist_vpn(new_vpn['name'])
-                        self._disconnect_vpn("tun2")
+                if switched:
+                    self._provision_spare_async()
+                    self._health_event.set()
+                    
+                    self.logger.info(f"VPN rotation completed: {old_primary.name if old_primary else 'None'} -> {new_vpn.name}")
                 
             except Exception as e:
                 self.logger.error(f"Rotation worker error: {str(e)}")
-                time.sleep(300)  # Wait 5 minutes before retrying
+                if self._stop_event.wait(300):  # Wait 5 minutes before retrying
+                    return
     
     def start(self):
         """Start the VPN rotation system"""
@@ -379,50 +707,85 @@ class VPNRotationManager:
             return False
         
         # Connect primary VPN
-        primary_vpn = random.choice(available_vpns)
-        if self._connect_vpn(primary_vpn, "tun0"):
-            if self._test_vpn_connectivity("tun0"):
+        primary_vpn = self._choose_vpn(available_vpns)
+        if self._connect_vpn(primary_vpn, self.primary_interface):
+            if self._test_vpn_connectivity(self.primary_interface, primary_vpn.name):
                 self.current_primary = primary_vpn
-                self._switch_primary_routing("tun0")
-                self.logger.info(f"Primary VPN connected: {primary_vpn['name']}")
+                self._switch_primary_routing(self.primary_interface)
+                self.logger.info(f"Primary VPN connected: {primary_vpn.name}")
             else:
-                self._blacklist_vpn(primary_vpn['name'])
+                self._blacklist_vpn(primary_vpn.name)
                 self.logger.error("Failed to establish primary VPN")
                 return False
         
         # Prepare secondary VPN
         self._prepare_new_secondary()
         
+        # Warm spare for rotation connects in the background
+        self._provision_spare_async()
+        
         # Start background workers
-        health_thread = threading.Thread(target=self._health_check_worker, daemon=True)
-        rotation_thread = threading.Thread(target=self._rotation_worker, daemon=True)
+        self._health_thread = threading.Thread(target=self._health_check_worker, daemon=True)
+        self._rotation_thread = threading.Thread(target=self._rotation_worker, daemon=True)
         
-        health_thread.start()
-        rotation_thread.start()
+        self._health_thread.start()
+        self._rotation_thread.start()
         
         self.logger.info("VPN Rotation Manager started successfully")
         
         # Keep main thread alive
         try:
-            while self.running:
-                time.sleep(1)
+            self._stop_event.wait()
         except KeyboardInterrupt:
             self.stop()
     
     def stop(self):
         """Stop the VPN rotation system"""
+        if self._stop_event.is_set():
+            return  # Already stopped
+        
         self.logger.info("Stopping VPN Rotation Manager")
         self.running = False
+        self._stop_event.set()
+        self._health_event.set()
+        self._probe_pool.shutdown(wait=False, cancel_futures=True)
+        
+        # Give workers a moment to finish what they are doing before teardown
+        for thread in (self._health_thread, self._rotation_thread, self._spare_thread):
+            if thread and thread.is_alive() and thread is not threading.current_thread():
+                thread.join(timeout=5)
         
         # Disconnect all VPNs
         for interface in ["tun0", "tun1", "tun2"]:
             self._disconnect_vpn(interface)
         
         # Clean up routing rules
-        self._run_command("iptables -t mangle -F VPN_ROUTING")
-        self._run_command("iptables -t mangle -X VPN_ROUTING")
+        try:
+            mangle = iptc.Table(iptc.Table.MANGLE)
+            mangle.refresh()
+            
+            # Drop the OUTPUT jump first, a referenced chain cannot be deleted
+            output = iptc.Chain(mangle, "OUTPUT")
+            for rule in output.rules:
+                if rule.target.name == "VPN_ROUTING":
+                    output.delete_rule(rule)
+            
+            iptc.Chain(mangle, "VPN_ROUTING").flush()
+            mangle.delete_chain("VPN_ROUTING")
+        except iptc.IPTCError as e:
+            self.logger.warning(f"Routing cleanup warning: {str(e)}")
+        self._ipr.close()
         
         self.logger.info("VPN Rotation Manager stopped")
+        
+        # Flush queued log records before the process exits
+        self._stop_log_listener()
+    
+    def _stop_log_listener(self):
+        """Flush and stop the log listener, safe to call more than once"""
+        listener, self._log_listener = self._log_listener, None
+        if listener:
+            listener.stop()
 
 if __name__ == "__main__":
     manager = VPNRotationManager()